@@ -4,113 +4,712 @@ Generates talking head videos from image + audio
 """
 
 import runpod
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
 import base64
+import contextlib
 import tempfile
 import os
 import sys
+import struct
 import subprocess
+import threading
 import shutil
+from collections import OrderedDict, deque
 from pathlib import Path
 
-# Add hallo to path
-sys.path.insert(0, '/app/hallo')
+# SIMD base64 when available, same API as the stdlib module
+try:
+    import pybase64 as b64
+except ImportError:
+    b64 = base64
+
+# SIMD hashing when available
+try:
+    from blake3 import blake3 as content_hash
+except ImportError:
+    from hashlib import blake2b as content_hash
+
+HALLO_DIR = '/app/hallo'
+HALLO_CONFIG = os.path.join(HALLO_DIR, 'configs/inference/default.yaml')
+HALLO_WEIGHTS = os.path.join(HALLO_DIR, 'pretrained_models')
+
+# Shared read-only model cache (RunPod model cache / network volume)
+WEIGHTS_CACHE_DIR = os.environ.get('HALLO_WEIGHTS_DIR', '/runpod/cache/model/fudan-generative-ai/hallo')
 
 # Global model cache
 HALLO_MODEL = None
 
+# Weight dtype override (fp16/bf16/fp32, default from the Hallo config) and
+# opt-in torch.compile of the denoising UNet (slow first job)
+HALLO_DTYPE = os.environ.get('HALLO_DTYPE') or None
+if HALLO_DTYPE not in (None, 'fp16', 'bf16', 'fp32'):
+    raise ValueError(f"HALLO_DTYPE must be fp16, bf16 or fp32, got {HALLO_DTYPE!r}")
+HALLO_COMPILE = os.environ.get('HALLO_COMPILE') == '1'
+
+# Run the wav2vec audio encoder as dynamic INT8 on CPU to free GPU memory
+HALLO_AUDIO_INT8 = os.environ.get('HALLO_AUDIO_INT8') == '1'
+
+# Model settings that affect the output, part of the output cache key
+MODEL_SETTINGS = f'dtype={HALLO_DTYPE}:compile={HALLO_COMPILE}:audio_int8={HALLO_AUDIO_INT8}'
+
+# Keep ffmpeg from contending with torch for every core; FFMPEG_CPUS
+# (e.g. "0,1") additionally pins it to a CPU set
+FFMPEG_THREADS = os.environ.get('FFMPEG_THREADS', '2')
+FFMPEG_CPUS = os.environ.get('FFMPEG_CPUS')
+
+# Jobs a worker accepts at once (RunPod concurrency_modifier)
+MAX_CONCURRENT = int(os.environ.get('VIDEO_MAX_CONCURRENT', '1'))
+
+# Model load, input preprocessing and denoising each run one job at a time,
+# so a concurrent job can preprocess while another holds the UNet
+MODEL_LOCK = threading.Lock()
+PREPROCESS_LOCK = threading.Lock()
+DENOISE_LOCK = threading.Lock()
+
+# Per-request inference settings; these don't require a model reload
+INFER_DEFAULTS = {
+    'pose_weight': 1.0,
+    'face_weight': 1.0,
+    'lip_weight': 1.0,
+    'face_expand_ratio': 1.2,
+}
+
+# Preprocessed image/audio features keyed by content hash
+FEATURE_CACHE = OrderedDict()
+FEATURE_CACHE_SIZE = 8
+
+# Finished videos keyed by input hash. Opt-in (e.g. a directory on the network
+# volume): entries are never evicted, so the directory needs outside cleanup
+OUTPUT_CACHE_DIR = os.environ.get('HALLO_OUTPUT_CACHE_DIR')
+
+# Job scratch space goes to tmpfs when it has room for inputs + output
+SHM_DIR = '/dev/shm'
+SHM_MIN_FREE = 1 << 30
+
+# Everything a job writes to its scratch dir: our inputs/output plus the
+# masks Hallo's ImageProcessor saves next to them
+JOB_FILES = (
+    'source.jpg', 'audio.mp3', 'output.mp4',
+    'source_face_mask.png', 'source_lip_mask.png', 'source_sep_background.png',
+    'source_sep_face.png', 'source_sep_lip.png', 'source_sep_pose.png',
+)
+
+# Shared HTTP session so warm workers reuse TCP/TLS connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+DOWNLOAD_CHUNK = 1 << 20
+
+# Base64 streaming chunk sizes (4 chars decode to 3 bytes). Staging I/O stays
+# blocking: at MiB-sized chunks it is one syscall per chunk, far too few for
+# io_uring batching to matter next to inference
+B64_DECODE_CHUNK = 4 << 20
+B64_ENCODE_CHUNK = 3 << 20
+
+
+def preallocate(f, size: int):
+    """Reserve size bytes up front for a file about to be written"""
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def advise_sequential(f):
+    """Tell the kernel f will be read front to back"""
+    if hasattr(os, 'posix_fadvise'):
+        fd = f.fileno()
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
 
 def download_file(url: str, output_path: str) -> bool:
     """Download file from URL"""
     try:
-        import requests
-        r = requests.get(url, timeout=120, stream=True)
-        if r.status_code == 200:
-            with open(output_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            return True
+        with SESSION.get(url, timeout=120, stream=True) as r:
+            if r.status_code == 200:
+                with open(output_path, 'wb') as f:
+                    preallocate(f, int(r.headers.get('Content-Length', 0)))
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                    f.truncate()
+                return True
     except Exception as e:
         print(f"Download error: {e}")
     return False
 
 
+def upload_file(url: str, path: str) -> bool:
+    """Stream a file to a presigned PUT URL"""
+    try:
+        with open(path, 'rb') as f:
+            advise_sequential(f)
+            r = SESSION.put(url, data=f, headers={'Content-Type': 'video/mp4'}, timeout=300)
+        if r.ok:
+            return True
+        print(f"Upload error: HTTP {r.status_code} {r.text[:200]}")
+    except Exception as e:
+        print(f"Upload error: {e}")
+    return False
+
+
+def make_tmpdir() -> str:
+    """Create a job scratch directory, preferring tmpfs"""
+    try:
+        if shutil.disk_usage(SHM_DIR).free >= SHM_MIN_FREE:
+            return tempfile.mkdtemp(dir=SHM_DIR)
+    except OSError:
+        pass
+    return tempfile.mkdtemp()
+
+
+def cleanup_tmpdir(tmpdir: str):
+    """Remove the files a job created, then the directory itself"""
+    for name in JOB_FILES:
+        try:
+            os.unlink(os.path.join(tmpdir, name))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(tmpdir)
+    except OSError:
+        # Something we didn't expect was left behind
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def decode_base64_to_file(data: str, output_path: str) -> int:
+    """Decode a base64 string to a file chunk by chunk, returns bytes written"""
+    written = 0
+    pending = ''
+    with open(output_path, 'wb') as f:
+        preallocate(f, len(data) // 4 * 3)
+        for start in range(0, len(data), B64_DECODE_CHUNK):
+            chunk = data[start:start + B64_DECODE_CHUNK]
+            # Drop embedded whitespace so chunks stay aligned to 4-char groups
+            chunk = ''.join(chunk.split())
+            chunk = pending + chunk
+            aligned = len(chunk) - len(chunk) % 4
+            pending = chunk[aligned:]
+            written += f.write(b64.b64decode(chunk[:aligned]))
+        if pending:
+            written += f.write(b64.b64decode(pending))
+        f.truncate()
+    return written
+
+
+def encode_file_to_base64(path: str) -> str:
+    """Base64 encode a file through one reused read buffer"""
+    with open(path, 'rb') as f:
+        advise_sequential(f)
+        size = os.fstat(f.fileno()).st_size
+        out = bytearray((size + 2) // 3 * 4)
+        buf = bytearray(B64_ENCODE_CHUNK)
+        view = memoryview(buf)
+        pos = 0
+        while n := f.readinto(buf):
+            encoded = b64.b64encode(view[:n])
+            out[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+    del out[pos:]
+    return out.decode('ascii')
+
+
+def read_mp4_duration(path: str) -> float:
+    """Read duration from the mvhd atom of an MP4 file"""
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        while f.tell() < end:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            size, kind = struct.unpack('>I4s', header)
+            offset = 8
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+                offset = 16
+            elif size == 0:
+                size = end - f.tell() + 8
+            if kind == b'moov':
+                # Descend into the movie box
+                end = f.tell() - offset + size
+                continue
+            if kind == b'mvhd':
+                version = f.read(4)[0]
+                if version == 1:
+                    timescale, duration = struct.unpack('>16xIQ', f.read(28))
+                else:
+                    timescale, duration = struct.unpack('>8xII', f.read(16))
+                return duration / timescale
+            if size < offset:
+                break
+            f.seek(size - offset, os.SEEK_CUR)
+    raise ValueError(f"No mvhd atom in {path}")
+
+
+def hash_file(path: str) -> str:
+    """Hex digest of a file's contents"""
+    h = content_hash()
+    with open(path, 'rb') as f:
+        advise_sequential(f)
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def output_cache_path(key: str):
+    """Path of the cached video for key, or None if the cache is disabled"""
+    if not OUTPUT_CACHE_DIR:
+        return None
+    return os.path.join(OUTPUT_CACHE_DIR, f'{key}.mp4')
+
+
+def store_output_cache(output_path: str, cache_path: str):
+    """Copy a finished video into the output cache"""
+    tmp_path = None
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Unique per call: concurrent jobs with identical inputs share cache_path
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Output cache write error: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def memoize_feature(key, compute):
+    """Return compute() cached in FEATURE_CACHE under key (None disables)"""
+    if key is None:
+        return compute()
+    if key in FEATURE_CACHE:
+        FEATURE_CACHE.move_to_end(key)
+        return FEATURE_CACHE[key]
+    value = compute()
+    FEATURE_CACHE[key] = value
+    if len(FEATURE_CACHE) > FEATURE_CACHE_SIZE:
+        FEATURE_CACHE.popitem(last=False)
+    return value
+
+
 def get_duration(path: str) -> float:
-    """Get video/audio duration using ffprobe"""
+    """Get video/audio duration from the file header, falling back to ffprobe"""
+    try:
+        if path.lower().endswith('.mp4'):
+            return read_mp4_duration(path)
+        import soundfile
+        return soundfile.info(path).duration
+    except Exception as e:
+        print(f"Header duration failed for {path}: {e}")
+
     try:
         result = subprocess.run([
             'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
             '-of', 'default=noprint_wrappers=1:nokey=1', path
-        ], capture_output=True, text=True, timeout=30)
+        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30)
         return float(result.stdout.strip())
     except:
         return 0.0
 
 
-def convert_audio_to_wav(input_path: str, output_path: str) -> bool:
-    """Convert audio to WAV format (16kHz, mono)"""
-    try:
-        subprocess.run([
-            'ffmpeg', '-y', '-i', input_path,
-            '-ar', '16000', '-ac', '1', '-acodec', 'pcm_s16le',
-            output_path
-        ], capture_output=True, timeout=60)
-        return os.path.exists(output_path)
-    except Exception as e:
-        print(f"Audio conversion error: {e}")
-        return False
+def decode_audio_ffmpeg(path: str, sample_rate: int):
+    """Decode audio to mono float32 through an ffmpeg stdout pipe"""
+    import numpy as np
+
+    result = subprocess.run(ffmpeg_command([
+        '-loglevel', 'error', '-i', path, '-vn',
+        '-ac', '1', '-ar', str(sample_rate), '-f', 'f32le', 'pipe:1',
+    ]), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg audio decode failed: {result.stderr.decode(errors='replace')[-1000:]}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
 
+def load_audio(path: str, sample_rate: int = 16000):
+    """Load audio as mono float32 resampled to sample_rate"""
+    import soundfile
+    import soxr
 
-def run_hallo_inference(image_path: str, audio_path: str, output_path: str) -> bool:
-    """Run Hallo inference using command line"""
     try:
-        # Convert audio to wav if needed
-        wav_path = audio_path
-        if not audio_path.lower().endswith('.wav'):
-            wav_path = audio_path.rsplit('.', 1)[0] + '.wav'
-            if not convert_audio_to_wav(audio_path, wav_path):
-                print("Failed to convert audio to WAV")
-                return False
-
-        # Hallo inference command
-        cmd = [
-            'python', '/app/hallo/scripts/inference.py',
-            '--source_image', image_path,
-            '--driving_audio', wav_path,
-            '--output', output_path,
-            '--pose_weight', '1.0',
-            '--face_weight', '1.0',
-            '--lip_weight', '1.0',
-            '--face_expand_ratio', '1.2',
-        ]
-
-        print(f"Running Hallo: {' '.join(cmd)}")
-
-        env = os.environ.copy()
-        env['PYTHONPATH'] = '/app/hallo:' + env.get('PYTHONPATH', '')
-
-        result = subprocess.run(
-            cmd,
-            cwd='/app/hallo',
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=600  # 10 min timeout
+        speech, sr = soundfile.read(path, dtype='float32')
+    except RuntimeError:
+        # Formats libsndfile can't read (AAC/M4A, WebM, ...)
+        return decode_audio_ffmpeg(path, sample_rate)
+    if speech.ndim > 1:
+        speech = speech.mean(axis=1)
+    if sr != sample_rate:
+        speech = soxr.resample(speech, sr, sample_rate)
+    return speech
+
+
+def tail_stream(stream, lines: deque):
+    """Drain a subprocess pipe, keeping only the last lines"""
+    for line in stream:
+        lines.append(line.decode(errors='replace').rstrip())
+
+
+def ffmpeg_command(args: list) -> list:
+    """ffmpeg command line with the thread cap and optional CPU pinning"""
+    cmd = ['ffmpeg', '-threads', FFMPEG_THREADS] + args
+    if FFMPEG_CPUS:
+        # taskset rather than preexec_fn, which is unsafe with threads running
+        cmd = ['taskset', '-c', FFMPEG_CPUS] + cmd
+    return cmd
+
+
+def write_video(frames, audio_path: str, output_path: str, fps: int):
+    """Encode [c, f, h, w] frames in [0, 1] and mux audio in one ffmpeg run"""
+    import torch
+
+    frames = (frames.clamp(0, 1) * 255).to(torch.uint8).permute(1, 2, 3, 0).contiguous().cpu()
+    _, height, width, _ = frames.shape
+    cmd = ffmpeg_command([
+        '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+        '-framerate', str(fps), '-i', 'pipe:0',
+        '-i', audio_path,
+        '-map', '0:v', '-map', '1:a',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest',
+        '-threads', FFMPEG_THREADS,
+        output_path,
+    ])
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    # Drain stderr concurrently so a chatty ffmpeg can't block on a full pipe
+    stderr_tail = deque(maxlen=50)
+    reader = threading.Thread(target=tail_stream, args=(proc.stderr, stderr_tail), daemon=True)
+    reader.start()
+    try:
+        for frame in frames.numpy():
+            proc.stdin.write(frame.tobytes())
+    except BrokenPipeError:
+        pass
+    finally:
+        proc.stdin.close()
+    returncode = proc.wait()
+    reader.join()
+    if returncode != 0:
+        raise RuntimeError("ffmpeg failed: " + '\n'.join(stderr_tail))
+
+
+def link_cached_weights():
+    """Use the shared weights cache when the image has no weights of its own"""
+    def has_weights(path):
+        return os.path.exists(os.path.join(path, 'hallo', 'net.pth'))
+
+    if has_weights(HALLO_WEIGHTS) or not has_weights(WEIGHTS_CACHE_DIR):
+        return
+    if os.path.islink(HALLO_WEIGHTS):
+        os.unlink(HALLO_WEIGHTS)
+    elif os.path.exists(HALLO_WEIGHTS):
+        os.rename(HALLO_WEIGHTS, HALLO_WEIGHTS + '.local')
+    os.symlink(WEIGHTS_CACHE_DIR, HALLO_WEIGHTS)
+    print(f"Using cached weights from {WEIGHTS_CACHE_DIR}")
+
+
+def get_model() -> dict:
+    """Return the resident Hallo model, loading it on first use"""
+    global HALLO_MODEL
+    if HALLO_MODEL is None:
+        with MODEL_LOCK:
+            if HALLO_MODEL is None:
+                HALLO_MODEL = load_model()
+    return HALLO_MODEL
+
+
+def add_hallo_path():
+    """Make the Hallo checkout importable"""
+    if HALLO_DIR not in sys.path:
+        sys.path.insert(0, HALLO_DIR)
+
+
+def preimport():
+    """Import torch, diffusers and Hallo ahead of the first job"""
+    add_hallo_path()
+    try:
+        import torch
+        import diffusers
+        import hallo.animate.face_animate
+        import hallo.datasets.audio_processor
+        import hallo.datasets.image_processor
+    except ImportError as e:
+        print(f"Preimport skipped: {e}")
+
+
+def load_model() -> dict:
+    """Build the Hallo pipeline and move it to the GPU"""
+    add_hallo_path()
+
+    import importlib
+    import torch
+    from omegaconf import OmegaConf
+    from diffusers import AutoencoderKL, DDIMScheduler
+    from hallo.animate.face_animate import FaceAnimatePipeline
+    from hallo.datasets.audio_processor import AudioProcessor
+    from hallo.datasets.image_processor import ImageProcessor
+    from hallo.models.audio_proj import AudioProjModel
+    from hallo.models.face_locator import FaceLocator
+    from hallo.models.image_proj import ImageProjModel
+    from hallo.models.unet_2d_condition import UNet2DConditionModel
+    from hallo.models.unet_3d import UNet3DConditionModel
+
+    print("Loading Hallo model...")
+
+    # Config paths are relative to the Hallo checkout
+    link_cached_weights()
+    os.chdir(HALLO_DIR)
+    inference = importlib.import_module('scripts.inference')
+    config = OmegaConf.load(HALLO_CONFIG)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype_name = HALLO_DTYPE or config.weight_dtype
+    if dtype_name == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print("bf16 not supported on this GPU, using fp16")
+        dtype_name = 'fp16'
+    if dtype_name == 'fp16':
+        weight_dtype = torch.float16
+    elif dtype_name == 'bf16':
+        weight_dtype = torch.bfloat16
+    elif dtype_name == 'fp32':
+        weight_dtype = torch.float32
+    else:
+        raise ValueError(f"Unsupported weight dtype {dtype_name!r} (fp16, bf16 or fp32)")
+
+    img_size = (config.data.source_image.width, config.data.source_image.height)
+    image_processor = ImageProcessor(img_size, config.face_analysis.model_path)
+
+    audio_separator_model_file = config.audio_separator.model_path
+    audio_processor = AudioProcessor(
+        config.data.driving_audio.sample_rate,
+        config.data.export_video.fps,
+        config.wav2vec.model_path,
+        config.wav2vec.features == 'last',
+        os.path.dirname(audio_separator_model_file),
+        os.path.basename(audio_separator_model_file),
+        os.path.join(HALLO_DIR, '.cache', 'audio_preprocess'),
+    )
+    if HALLO_AUDIO_INT8:
+        audio_processor.audio_encoder = torch.ao.quantization.quantize_dynamic(
+            audio_processor.audio_encoder.float().cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+
+    sched_kwargs = OmegaConf.to_container(config.noise_scheduler_kwargs)
+    if config.enable_zero_snr:
+        sched_kwargs.update(
+            rescale_betas_zero_snr=True,
+            timestep_spacing='trailing',
+            prediction_type='v_prediction',
         )
+    scheduler = DDIMScheduler(**sched_kwargs)
+
+    vae = AutoencoderKL.from_pretrained(config.vae.model_path)
+    reference_unet = UNet2DConditionModel.from_pretrained(
+        config.base_model_path, subfolder='unet')
+    denoising_unet = UNet3DConditionModel.from_pretrained_2d(
+        config.base_model_path,
+        config.motion_module_path,
+        subfolder='unet',
+        unet_additional_kwargs=OmegaConf.to_container(config.unet_additional_kwargs),
+        use_landmark=False,
+    )
+    face_locator = FaceLocator(conditioning_embedding_channels=320)
+    image_proj = ImageProjModel(
+        cross_attention_dim=denoising_unet.config.cross_attention_dim,
+        clip_embeddings_dim=512,
+        clip_extra_context_tokens=4,
+    )
+    audio_proj = AudioProjModel(
+        seq_len=5,
+        blocks=12,
+        channels=768,
+        intermediate_dim=512,
+        output_dim=768,
+        context_tokens=32,
+    ).to(device=device, dtype=weight_dtype)
+
+    for module in (vae, reference_unet, denoising_unet, face_locator, image_proj, audio_proj):
+        module.requires_grad_(False)
+
+    net = inference.Net(reference_unet, denoising_unet, face_locator, image_proj, audio_proj)
+    missing, unexpected = net.load_state_dict(torch.load(
+        os.path.join(config.audio_ckpt_dir, 'net.pth'), map_location='cpu'))
+    if missing or unexpected:
+        raise RuntimeError("Failed to load Hallo checkpoint (net.pth)")
+
+    pipeline = FaceAnimatePipeline(
+        vae=vae,
+        reference_unet=net.reference_unet,
+        denoising_unet=net.denoising_unet,
+        face_locator=net.face_locator,
+        scheduler=scheduler,
+        image_proj=net.imageproj,
+    )
+    pipeline.to(device=device, dtype=weight_dtype)
+    if HALLO_COMPILE:
+        # Input shapes are fixed by the config, so CUDA graphs can be reused
+        pipeline.denoising_unet = torch.compile(
+            pipeline.denoising_unet, mode='reduce-overhead', fullgraph=False)
+
+    model = {
+        'config': config,
+        'img_size': img_size,
+        'pipeline': pipeline,
+        'audio_proj': net.audioproj,
+        'image_processor': image_processor,
+        'audio_processor': audio_processor,
+        'process_audio_emb': inference.process_audio_emb,
+        # Preprocessing runs on its own stream to overlap with denoising
+        'preprocess_stream': torch.cuda.Stream() if device.type == 'cuda' else None,
+    }
+    print(f"Hallo model loaded ({weight_dtype}, compile={HALLO_COMPILE})")
+    return model
+
+
+def encode_audio(model: dict, audio_path: str, clip_length: int):
+    """Compute wav2vec embeddings for audio_path, resampling in-process"""
+    import math
+    import torch
+
+    config = model['config']
+    audio_processor = model['audio_processor']
+    sample_rate = config.data.driving_audio.sample_rate
+    fps = config.data.export_video.fps
+
+    separator = audio_processor.audio_separator
+    if separator is not None:
+        outputs = [os.path.join(separator.output_dir, name)
+                   for name in separator.separate(audio_path)]
+        if not outputs:
+            raise RuntimeError("Audio separation failed")
+        try:
+            speech = load_audio(outputs[0], sample_rate)
+        finally:
+            for path in outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+    else:
+        speech = load_audio(audio_path, sample_rate)
+
+    audio_feature = audio_processor.wav2vec_feature_extractor(
+        speech, sampling_rate=sample_rate).input_values[0]
+    seq_len = math.ceil(len(audio_feature) / sample_rate * fps)
+    audio_length = seq_len
+
+    audio_encoder = audio_processor.audio_encoder
+    audio_feature = torch.from_numpy(audio_feature).float().to(device=audio_encoder.device)
+    if seq_len % clip_length != 0:
+        pad = clip_length - seq_len % clip_length
+        audio_feature = torch.nn.functional.pad(audio_feature, (0, pad * (sample_rate // fps)))
+        seq_len += pad
+
+    with torch.no_grad():
+        embeddings = audio_encoder(
+            audio_feature.unsqueeze(0), seq_len=seq_len, output_hidden_states=True)
+    if config.wav2vec.features == 'last':
+        audio_emb = embeddings.last_hidden_state.squeeze()
+    else:
+        audio_emb = torch.stack(embeddings.hidden_states[1:], dim=1).squeeze(0)
+    audio_emb = audio_emb.permute(1, 0, 2).cpu()
+    return audio_emb, audio_length
 
-        if result.returncode != 0:
-            print(f"Hallo STDOUT: {result.stdout[-1000:]}")
-            print(f"Hallo STDERR: {result.stderr[-1000:]}")
-            return False
 
-        # Clean up temp wav
-        if wav_path != audio_path and os.path.exists(wav_path):
-            os.remove(wav_path)
+def infer(image_path: str, audio_path: str, output_path: str,
+          pose_weight: float = 1.0, face_weight: float = 1.0,
+          lip_weight: float = 1.0, face_expand_ratio: float = 1.2,
+          image_key: str = None, audio_key: str = None) -> bool:
+    """Run Hallo inference with the resident model
+
+    Intermediate masks are written next to output_path. When image_key /
+    audio_key (content hashes) are given, preprocessing results are reused.
+    """
+    try:
+        import torch
+
+        model = get_model()
+        config = model['config']
+        pipeline = model['pipeline']
+        audio_proj = model['audio_proj']
+        img_size = model['img_size']
+        clip_length = config.data.n_sample_frames
+        n_motion_frames = config.data.n_motion_frames
+        cache_dir = os.path.dirname(output_path)
+
+        stream = model['preprocess_stream']
+        stream_ctx = torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+        with PREPROCESS_LOCK, stream_ctx:
+            (source_image_pixels, source_image_face_region, source_image_face_emb,
+             source_image_full_mask, source_image_face_mask, source_image_lip_mask
+             ) = memoize_feature(
+                image_key and ('image', image_key, face_expand_ratio),
+                lambda: model['image_processor'].preprocess(
+                    image_path, cache_dir, face_expand_ratio))
+
+            audio_emb, audio_length = memoize_feature(
+                audio_key and ('audio', audio_key),
+                lambda: encode_audio(model, audio_path, clip_length))
+            if stream is not None:
+                stream.synchronize()
+        audio_emb = model['process_audio_emb'](audio_emb)
+
+        source_image_pixels = source_image_pixels.unsqueeze(0)
+        source_image_face_region = source_image_face_region.unsqueeze(0)
+        source_image_face_emb = torch.tensor(source_image_face_emb.reshape(1, -1))
+        source_image_full_mask = [m.repeat(clip_length, 1) for m in source_image_full_mask]
+        source_image_face_mask = [m.repeat(clip_length, 1) for m in source_image_face_mask]
+        source_image_lip_mask = [m.repeat(clip_length, 1) for m in source_image_lip_mask]
+
+        motion_scale = [pose_weight, face_weight, lip_weight]
+        times = audio_emb.shape[0] // clip_length
+        tensor_result = []
+
+        with DENOISE_LOCK, torch.no_grad():
+            generator = torch.manual_seed(42)
+            for t in range(times):
+                print(f"Clip {t + 1}/{times}")
+                if not tensor_result:
+                    motion_frames = source_image_pixels.repeat(n_motion_frames, 1, 1, 1)
+                else:
+                    motion_frames = tensor_result[-1][0].permute(1, 0, 2, 3)
+                    motion_frames = motion_frames[-n_motion_frames:] * 2.0 - 1.0
+                motion_frames = motion_frames.to(
+                    dtype=source_image_pixels.dtype, device=source_image_pixels.device)
+                pixel_values_ref_img = torch.cat(
+                    [source_image_pixels, motion_frames], dim=0).unsqueeze(0)
+
+                audio_tensor = audio_emb[t * clip_length:(t + 1) * clip_length].unsqueeze(0)
+                audio_tensor = audio_tensor.to(device=audio_proj.device, dtype=audio_proj.dtype)
+                audio_tensor = audio_proj(audio_tensor)
+
+                pipeline_output = pipeline(
+                    ref_image=pixel_values_ref_img,
+                    audio_tensor=audio_tensor,
+                    face_emb=source_image_face_emb,
+                    face_mask=source_image_face_region,
+                    pixel_values_full_mask=source_image_full_mask,
+                    pixel_values_face_mask=source_image_face_mask,
+                    pixel_values_lip_mask=source_image_lip_mask,
+                    width=img_size[0],
+                    height=img_size[1],
+                    video_length=clip_length,
+                    num_inference_steps=config.inference_steps,
+                    guidance_scale=config.cfg_scale,
+                    generator=generator,
+                    motion_scale=motion_scale,
+                )
+                tensor_result.append(pipeline_output.videos)
+
+        tensor_result = torch.cat(tensor_result, dim=2).squeeze(0)
+        tensor_result = tensor_result[:, :audio_length]
+        write_video(tensor_result, audio_path, output_path, config.data.export_video.fps)
 
         return os.path.exists(output_path) and os.path.getsize(output_path) > 10000
 
-    except subprocess.TimeoutExpired:
-        print("Hallo timeout!")
-        return False
     except Exception as e:
         print(f"Hallo error: {e}")
         import traceback
@@ -118,7 +717,23 @@ def run_hallo_inference(image_path: str, audio_path: str, output_path: str) -> b
         return False
 
 
-def handler(event):
+def log_model_load_error(task: asyncio.Future):
+    """Report a failed background model load, even if no job awaits it"""
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Model load error: {task.exception()!r}")
+
+
+def stage_input(job_input: dict, name: str, path: str) -> bool:
+    """Write the <name>_base64 or <name>_url job input to path"""
+    if f'{name}_base64' in job_input:
+        print(f"Decoding {name} from base64...")
+        decode_base64_to_file(job_input[f'{name}_base64'], path)
+        return True
+    print(f"Downloading {name} from URL...")
+    return download_file(job_input[f'{name}_url'], path)
+
+
+async def handler(event):
     """
     RunPod serverless handler
 
@@ -127,9 +742,14 @@ def handler(event):
         - audio_base64: Base64 encoded audio file (MP3/WAV)
         - image_url: URL to download image (alternative)
         - audio_url: URL to download audio (alternative)
+        - output_upload_url: Presigned PUT URL for the output video (optional)
+        - pose_weight, face_weight, lip_weight: Motion scales (default 1.0)
+        - face_expand_ratio: Face region expansion (default 1.2)
 
     Output:
         - video_base64: Base64 encoded output video (MP4)
+        - video_url: Uploaded video URL, instead of video_base64 when
+          output_upload_url is given
         - duration: Video duration in seconds
         - error: Error message if failed
     """
@@ -142,61 +762,87 @@ def handler(event):
         job_input = event.get('input', {})
 
         # Create temp directory
-        tmpdir = tempfile.mkdtemp()
+        tmpdir = make_tmpdir()
         try:
             image_path = os.path.join(tmpdir, 'source.jpg')
             audio_path = os.path.join(tmpdir, 'audio.mp3')
             output_path = os.path.join(tmpdir, 'output.mp4')
 
-            # Get image
-            if 'image_base64' in job_input:
-                print("Decoding image from base64...")
-                image_data = base64.b64decode(job_input['image_base64'])
-                with open(image_path, 'wb') as f:
-                    f.write(image_data)
-            elif 'image_url' in job_input:
-                print(f"Downloading image from URL...")
-                if not download_file(job_input['image_url'], image_path):
-                    return {'error': 'Failed to download image'}
-            else:
+            if 'image_base64' not in job_input and 'image_url' not in job_input:
                 return {'error': 'No image provided (image_base64 or image_url required)'}
-
-            # Get audio
-            if 'audio_base64' in job_input:
-                print("Decoding audio from base64...")
-                audio_data = base64.b64decode(job_input['audio_base64'])
-                with open(audio_path, 'wb') as f:
-                    f.write(audio_data)
-            elif 'audio_url' in job_input:
-                print(f"Downloading audio from URL...")
-                if not download_file(job_input['audio_url'], audio_path):
-                    return {'error': 'Failed to download audio'}
-            else:
+            if 'audio_base64' not in job_input and 'audio_url' not in job_input:
                 return {'error': 'No audio provided (audio_base64 or audio_url required)'}
 
+            # Load the model (first job only) while inputs are fetched
+            model_task = asyncio.ensure_future(asyncio.to_thread(get_model))
+            # Early returns and cache hits never await it
+            model_task.add_done_callback(log_model_load_error)
+
+            image_ok, audio_ok = await asyncio.gather(
+                asyncio.to_thread(stage_input, job_input, 'image', image_path),
+                asyncio.to_thread(stage_input, job_input, 'audio', audio_path),
+            )
+            if not image_ok:
+                return {'error': 'Failed to download image'}
+            if not audio_ok:
+                return {'error': 'Failed to download audio'}
+
             image_size = os.path.getsize(image_path)
             audio_size = os.path.getsize(audio_path)
-            audio_duration = get_duration(audio_path)
+            # Hash and probe off the event loop; it is shared with other jobs
+            audio_duration, image_key, audio_key = await asyncio.gather(
+                asyncio.to_thread(get_duration, audio_path),
+                asyncio.to_thread(hash_file, image_path),
+                asyncio.to_thread(hash_file, audio_path),
+            )
 
             print(f"Input: image={image_size}B, audio={audio_size}B ({audio_duration:.1f}s)")
 
-            # Run Hallo
-            print("Starting Hallo inference...")
-            if not run_hallo_inference(image_path, audio_path, output_path):
-                return {'error': 'Hallo inference failed'}
+            params = {name: float(job_input.get(name, default))
+                      for name, default in INFER_DEFAULTS.items()}
+            cache_key = content_hash(
+                f'{image_key}:{audio_key}:{sorted(params.items())}:{MODEL_SETTINGS}'.encode()
+            ).hexdigest()
+            cache_path = output_cache_path(cache_key[:64])
+
+            if cache_path and os.path.exists(cache_path):
+                print("Output cache hit, skipping inference")
+                await asyncio.to_thread(shutil.copyfile, cache_path, output_path)
+            else:
+                await model_task
+
+                # Run Hallo
+                print("Starting Hallo inference...")
+                if not await asyncio.to_thread(
+                        infer, image_path, audio_path, output_path,
+                        image_key=image_key, audio_key=audio_key, **params):
+                    return {'error': 'Hallo inference failed'}
+                if cache_path:
+                    await asyncio.to_thread(store_output_cache, output_path, cache_path)
 
             # Check output
             if not os.path.exists(output_path):
                 return {'error': 'No output video generated'}
 
             output_size = os.path.getsize(output_path)
-            output_duration = get_duration(output_path)
+            output_duration = await asyncio.to_thread(get_duration, output_path)
 
             print(f"Output: {output_size}B ({output_duration:.1f}s)")
 
+            upload_url = job_input.get('output_upload_url')
+            if upload_url:
+                print("Uploading output video...")
+                if not await asyncio.to_thread(upload_file, upload_url, output_path):
+                    return {'error': 'Failed to upload output video'}
+                print("Success!")
+                return {
+                    'video_url': upload_url.split('?')[0],
+                    'duration': output_duration,
+                    'size_bytes': output_size
+                }
+
             # Encode output
-            with open(output_path, 'rb') as f:
-                video_base64 = base64.b64encode(f.read()).decode('utf-8')
+            video_base64 = await asyncio.to_thread(encode_file_to_base64, output_path)
 
             print("Success!")
             return {
@@ -207,7 +853,7 @@ def handler(event):
 
         finally:
             # Cleanup
-            shutil.rmtree(tmpdir, ignore_errors=True)
+            await asyncio.to_thread(cleanup_tmpdir, tmpdir)
 
     except Exception as e:
         import traceback
@@ -219,6 +865,11 @@ def handler(event):
         }
 
 
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Number of jobs this worker takes at once, capped by GPU memory"""
+    return MAX_CONCURRENT
+
+
 # For local testing
 def local_test():
     """Test handler locally"""
@@ -226,36 +877,46 @@ def local_test():
     if len(sys.argv) >= 3:
         image_path = sys.argv[1]
         audio_path = sys.argv[2]
+        # get_model() changes into the Hallo checkout
+        save_path = os.path.abspath(sys.argv[3]) if len(sys.argv) >= 4 else None
 
         with open(image_path, 'rb') as f:
-            image_b64 = base64.b64encode(f.read()).decode()
+            image_b64 = b64.b64encode(f.read()).decode()
         with open(audio_path, 'rb') as f:
-            audio_b64 = base64.b64encode(f.read()).decode()
+            audio_b64 = b64.b64encode(f.read()).decode()
 
-        result = handler({
+        result = asyncio.run(handler({
             'input': {
                 'image_base64': image_b64,
                 'audio_base64': audio_b64
             }
-        })
+        }))
 
         if 'error' in result:
             print(f"Error: {result['error']}")
         else:
             print(f"Success! Duration: {result['duration']}s")
             # Save output
-            if len(sys.argv) >= 4:
-                with open(sys.argv[3], 'wb') as f:
-                    f.write(base64.b64decode(result['video_base64']))
-                print(f"Saved to: {sys.argv[3]}")
+            if save_path:
+                with open(save_path, 'wb') as f:
+                    f.write(b64.b64decode(result['video_base64']))
+                print(f"Saved to: {save_path}")
     else:
         print("Usage: python handler.py <image> <audio> [output.mp4]")
 
 
+# Pay the heavy import cost at container start rather than on the first job
+if os.environ.get('HALLO_SKIP_PREIMPORT') != '1':
+    preimport()
+
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
         local_test()
     else:
         # RunPod serverless start
-        runpod.serverless.start({'handler': handler})
+        runpod.serverless.start({
+            'handler': handler,
+            'concurrency_modifier': concurrency_modifier,
+        })